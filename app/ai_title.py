@@ -1,72 +1,280 @@
 ﻿import os
 import re
+import gzip
+import functools
 import json
+import random
+import hashlib
+import asyncio
 import logging
 import httpx
+import orjson
 from html import unescape
 
+from .ingest import SSL_CONTEXT
+
 _log = logging.getLogger("title.llm")
 
+# Optional C-backed HTML parser; the regex path below is the fallback.
+try:
+    from selectolax.parser import HTMLParser as _HTMLParser
+except ImportError:  # pragma: no cover
+    _HTMLParser = None
+
+# Compiled once at import; these run on every row. Script/style/tag removal
+# is one alternation so the fallback strips in a single rewrite pass.
+_RE_STRIP = re.compile(r"<script[^>]*>.*?</script>|<style[^>]*>.*?</style>|<[^>]+>", re.I | re.S)
+_RE_WS = re.compile(r"\s+")
+_RE_TITLE = re.compile(r"\s+|\((OBS:[^)]*kvar)\)", re.I)
+
+# How many batched chat completions may be in flight at once; each call
+# already carries ASSESS_BATCH_SIZE titles, so this stays small.
+ASSESS_MAX_CONCURRENT = int(os.getenv("ASSESS_MAX_CONCURRENT", "4"))
+
+# How many titles are folded into one chat completion by assess_many.
+ASSESS_BATCH_SIZE = int(os.getenv("ASSESS_BATCH_SIZE", "32"))
+
+# Long-lived clients so connections (DNS, TCP, TLS) are reused across calls
+# instead of being rebuilt per request. Created lazily, closed on app shutdown.
+_OPENAI_CLIENT: httpx.AsyncClient | None = None
+_SCRAPE_CLIENT: httpx.AsyncClient | None = None
+
+def _openai_client() -> httpx.AsyncClient:
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None or _OPENAI_CLIENT.is_closed:
+        # HTTP/2 lets one TLS connection multiplex the whole batch.
+        _OPENAI_CLIENT = httpx.AsyncClient(
+            base_url="https://api.openai.com",
+            http2=True,
+            verify=SSL_CONTEXT,
+            timeout=httpx.Timeout(12.0, connect=3.0),
+            limits=httpx.Limits(
+                max_connections=128,
+                max_keepalive_connections=64,
+                keepalive_expiry=60,
+            ),
+        )
+    return _OPENAI_CLIENT
+
+def _scrape_client() -> httpx.AsyncClient:
+    global _SCRAPE_CLIENT
+    if _SCRAPE_CLIENT is None or _SCRAPE_CLIENT.is_closed:
+        # Product URLs are almost all on one host, so keep connections warm
+        # long enough to amortize DNS + TLS over the whole batch.
+        _SCRAPE_CLIENT = httpx.AsyncClient(
+            timeout=8,
+            follow_redirects=True,
+            verify=SSL_CONTEXT,
+            headers={"User-Agent": "Mozilla/5.0"},
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=120),
+            transport=httpx.AsyncHTTPTransport(retries=1),
+        )
+    return _SCRAPE_CLIENT
+
+async def prewarm_scrape_client(url: str = "https://hefitness.se/") -> None:
+    """Open the scrape pool at startup so the first rows skip the handshake."""
+    try:
+        await _scrape_client().head(url, timeout=3)
+    except Exception:
+        pass
+
+async def aclose_clients() -> None:
+    """Close the shared clients (wired to FastAPI shutdown)."""
+    for c in (_OPENAI_CLIENT, _SCRAPE_CLIENT):
+        if c is not None and not c.is_closed:
+            await c.aclose()
+
+# Assessment cache: in-memory dict first, then the llm_cache table, so
+# unchanged rows on a re-ingest skip the paid OpenAI call entirely.
+_STABLE_FIELDS = ("URL", "url", "Artnr", "artnr", "Varugrupp", "category",
+                  "Produktnamn", "name", "Tillverkare", "manufacturer",
+                  "Modell", "model", "EAN", "ean", "Pris", "price",
+                  "Frakt", "shipping", "Beskrivning", "description_html")
+_ASSESS_MEM: dict[str, dict] = {}
+
+def _assess_cache_key(row: dict) -> str:
+    stable = {k: row.get(k) for k in _STABLE_FIELDS if row.get(k) not in (None, "")}
+    blob = json.dumps(stable, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+def _assess_cache_get(key: str) -> dict | None:
+    hit = _ASSESS_MEM.get(key)
+    if hit is not None:
+        return hit
+    try:
+        from sqlmodel import Session
+        from .db import engine
+        from .models import LlmCache
+        with Session(engine) as session:
+            row = session.get(LlmCache, key)
+            if row is not None:
+                obj = json.loads(row.response)
+                _ASSESS_MEM[key] = obj
+                return obj
+    except Exception:
+        pass
+    return None
+
+def _assess_cache_put(key: str, obj: dict) -> None:
+    _ASSESS_MEM[key] = obj
+    try:
+        from sqlmodel import Session
+        from .db import engine
+        from .models import LlmCache
+        with Session(engine) as session:
+            session.merge(LlmCache(key=key, response=json.dumps(obj, ensure_ascii=False)))
+            session.commit()
+    except Exception:
+        pass
+
 def _strip_html(text: str) -> str:
+    if _HTMLParser is not None:
+        try:
+            tree = _HTMLParser(text or "")
+            for node in tree.css("script,style"):
+                node.decompose()
+            return " ".join(tree.text(separator=" ").split())
+        except Exception:
+            pass
     text = unescape(text or "")
-    text = re.sub(r"<script[^>]*>.*?</script>", " ", text, flags=re.I | re.S)
-    text = re.sub(r"<style[^>]*>.*?</style>", " ", text, flags=re.I | re.S)
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
+    text = _RE_STRIP.sub(" ", text)
+    text = _RE_WS.sub(" ", text).strip()
     return text
 
+# Per-URL excerpt cache with HTTP revalidation: a 304 reply skips both the
+# body download and the HTML strip on repeat ingests.
+_PAGE_CACHE: dict[str, tuple[str | None, str | None, str]] = {}
+
 async def _fetch_url_text(url: str | None, timeout_sec: int = 8, max_chars: int = 2000) -> str:
     if not url or not isinstance(url, str) or not url.startswith("http"):
         return ""
+    cached = _PAGE_CACHE.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
     try:
-        async with httpx.AsyncClient(timeout=timeout_sec, follow_redirects=True) as client:
-            r = await client.get(url, headers={"User-Agent": "Mozilla/5.0"})
+        async with _scrape_client().stream("GET", url, timeout=timeout_sec,
+                                           headers=headers or None) as r:
+            if r.status_code == 304 and cached:
+                return cached[2]
             r.raise_for_status()
-            return _strip_html(r.text)[:max_chars]
+            # read only enough bytes to cover max_chars of visible text
+            # (8x headroom for markup) instead of the whole page
+            buf = bytearray()
+            async for chunk in r.aiter_bytes():
+                buf.extend(chunk)
+                if len(buf) > max_chars * 8:
+                    break
+        excerpt = _strip_html(buf.decode("utf-8", "replace"))[:max_chars]
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if etag or last_modified:
+            _PAGE_CACHE[url] = (etag, last_modified, excerpt)
+        return excerpt
     except Exception:
         return ""
 
+# Static prompt text evaluated once; _build_assess_prompt only fills the holes.
+_PROMPT_HEAD = (
+    "Task: Evaluate the current product title and, if it is weak or unclear, propose a better one.\n"
+    "Return STRICT JSON: {\"name_quality\":\"ok|weak|empty|cant_generate\",\"suggested_title\":null|string}.\n"
+    "Rules:\n"
+    "- Keep original language (Swedish stays Swedish).\n"
+    "- empty => generate suggestion; weak => generate suggestion; ok => no suggestion.\n"
+    "- Concise, <= 90 characters, no clickbait.\n\n"
+)
+
+# (label, feed key, mapped key) for each prompt hole, in output order
+_PROMPT_FIELDS = (
+    ("URL", "URL", "url"),
+    ("Artnr", "Artnr", "artnr"),
+    ("Category", "Varugrupp", "category"),
+    ("Title", "Produktnamn", "name"),
+    ("Manufacturer", "Tillverkare", "manufacturer"),
+    ("Model", "Modell", "model"),
+    ("EAN", "EAN", "ean"),
+    ("Price", "Pris", "price"),
+    ("Shipping", "Frakt", "shipping"),
+    ("Description (feed)", "Beskrivning", "description_html"),
+)
+
 def _build_assess_prompt(row: dict, page_excerpt: str) -> str:
-    return (
-        "Task: Evaluate the current product title and, if it is weak or unclear, propose a better one.\n"
-        "Return STRICT JSON: {\"name_quality\":\"ok|weak|empty|cant_generate\",\"suggested_title\":null|string}.\n"
-        "Rules:\n"
-        "- Keep original language (Swedish stays Swedish).\n"
-        "- empty => generate suggestion; weak => generate suggestion; ok => no suggestion.\n"
-        "- Concise, <= 90 characters, no clickbait.\n\n"
-        f"URL: {row.get('URL') or row.get('url')}\n"
-        f"Artnr: {row.get('Artnr') or row.get('artnr')}\n"
-        f"Category: {row.get('Varugrupp') or row.get('category')}\n"
-        f"Title: {row.get('Produktnamn') or row.get('name')}\n"
-        f"Manufacturer: {row.get('Tillverkare') or row.get('manufacturer')}\n"
-        f"Model: {row.get('Modell') or row.get('model')}\n"
-        f"EAN: {row.get('EAN') or row.get('ean')}\n"
-        f"Price: {row.get('Pris') or row.get('price')}\n"
-        f"Shipping: {row.get('Frakt') or row.get('shipping')}\n"
-        f"Description (feed): {row.get('Beskrivning') or row.get('description_html')}\n"
-        f"Page excerpt: {page_excerpt}\n"
-    )
+    get = row.get
+    parts = [_PROMPT_HEAD]
+    for label, feed_key, mapped_key in _PROMPT_FIELDS:
+        parts += (label, ": ", str(get(feed_key) or get(mapped_key)), "\n")
+    parts += ("Page excerpt: ", page_excerpt, "\n")
+    return "".join(parts)
+
+# compiled once: a title that is one bare SKU/model token ("Abc-123/Xl-99")
+# carries no product information however long it is
+_SKU_ONLY_RE = re.compile(r"[A-Za-z0-9\-_/]+")
+_GENERIC_TITLES = frozenset({"produkt", "product", "unknown", "n/a", "na"})
 
+def is_ok_title(t: str | None) -> bool:
+    """Cheap local check: titles that already look clean skip the LLM."""
+    return bool(t) and 10 <= len(t) <= 90 and not t.isupper() and "  " not in t \
+        and t.lower() not in _GENERIC_TITLES and _SKU_ONLY_RE.fullmatch(t) is None \
+        and sum(c.isalpha() for c in t) >= 5
+
+# Memoized like the numeric coercers in main: variant rows repeat the same
+# product name, so each unique title is cleaned once per process.
+@functools.lru_cache(maxsize=4096)
 def heuristic_improve_title(title: str | None) -> str | None:
     if not title:
         return None
-    t = re.sub(r"\s+", " ", title).strip()
-    t = re.sub(r"\((OBS:.*?kvar)\)", "", t, flags=re.I).strip()
+    # one pass: whitespace runs -> " ", "(OBS: ... kvar)" markers -> ""
+    t = _RE_TITLE.sub(lambda m: "" if m.group(1) else " ", title).strip()
     t = t.replace("Hefitness", "HEfitness").replace(" ;", ";")
     return t[:1].upper() + t[1:] if t else None
 
-async def generate_title_assessment_openai(row: dict, timeout_sec: int = 12):
+async def _post_with_retry(client: httpx.AsyncClient, content: bytes, headers: dict,
+                           attempts: int = 4) -> httpx.Response:
+    """POST to chat/completions, retrying 429/5xx and transport errors
+    with backoff + jitter; other 4xx are deterministic and surface at once."""
+    for i in range(attempts):
+        try:
+            r = await client.post("https://api.openai.com/v1/chat/completions",
+                                  headers=headers, content=content)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise httpx.HTTPStatusError("retryable status", request=r.request, response=r)
+            r.raise_for_status()
+            return r
+        except httpx.HTTPStatusError as e:
+            code = e.response.status_code
+            if (code != 429 and code < 500) or i == attempts - 1:
+                raise
+            await asyncio.sleep(min(2 ** i, 8) + random.random())
+        except httpx.HTTPError:
+            if i == attempts - 1:
+                raise
+            await asyncio.sleep(min(2 ** i, 8) + random.random())
+
+async def generate_title_assessment_openai(row: dict, timeout_sec: int = 12,
+                                           client: httpx.AsyncClient | None = None,
+                                           sem: asyncio.Semaphore | None = None):
     """
     Always assess the title (uses fields + fetched product page content).
     Returns dict:
       { "name_quality": "ok|weak|empty|cant_generate", "suggested_title": str|null }
     Returns None on failure. Never raises.
+    Pass a shared `client` (and optionally `sem`) when calling in a batch.
     """
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         _log.info("try_openai: key=no")
         return None
 
+    cache_key = _assess_cache_key(row)
+    cached = _assess_cache_get(cache_key)
+    if cached is not None:
+        _log.info("openai_cache_hit")
+        return cached
+
     url = row.get("URL") or row.get("url")
     excerpt = await _fetch_url_text(url)
     payload = {
@@ -82,17 +290,154 @@ async def generate_title_assessment_openai(row: dict, timeout_sec: int = 12):
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
     try:
-        async with httpx.AsyncClient(timeout=timeout_sec) as client:
+        if sem is not None:
+            await sem.acquire()
+        try:
             _log.info("try_openai: key=yes url=%s", (url or "")[:120])
-            r = await client.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
-            text = (data.get("choices") or [{}])[0].get("message", {}).get("content") or ""
-            obj = json.loads(text)
-            if isinstance(obj, dict) and "name_quality" in obj:
-                _log.info("openai_ok")
-                return obj
+            obj = await _chat_json(client if client is not None else _openai_client(),
+                                   payload, headers)
+        finally:
+            if sem is not None:
+                sem.release()
+        if isinstance(obj, dict) and "name_quality" in obj:
+            _log.info("openai_ok")
+            _assess_cache_put(cache_key, obj)
+            return obj
+        return None
     except Exception:
         _log.info("openai_fail")
         return None
-    return None
+
+# Request-body compression is opt-in: the API must be verified to accept
+# Content-Encoding: gzip before setting OPENAI_GZIP_BODY=1. When a compressed
+# body is rejected (400/413/415) the call retries plain and compression stays
+# off for the rest of the process, so assessments keep flowing either way.
+_GZIP_BODY = os.getenv("OPENAI_GZIP_BODY", "0") == "1"
+
+async def _chat_json(client: httpx.AsyncClient, payload: dict, headers: dict):
+    """POST a chat payload and return its parsed JSON content."""
+    global _GZIP_BODY
+    body = orjson.dumps(payload)
+    if _GZIP_BODY:
+        gz_headers = {**headers, "Content-Encoding": "gzip", "Accept-Encoding": "gzip, br"}
+        try:
+            r = await _post_with_retry(client, gzip.compress(body), gz_headers)
+        except httpx.HTTPStatusError as e:
+            if e.response is not None and e.response.status_code in (400, 413, 415):
+                _GZIP_BODY = False
+                r = await _post_with_retry(client, body, headers)
+            else:
+                raise
+    else:
+        r = await _post_with_retry(client, body, headers)
+    data = orjson.loads(r.content)
+    text = (data.get("choices") or [{}])[0].get("message", {}).get("content") or ""
+    return orjson.loads(text)
+
+def _build_batch_prompt(rows: list[dict], excerpts: list[str]) -> str:
+    parts = [
+        "Task: For each numbered product below, evaluate the current title and, "
+        "if it is weak or unclear, propose a better one.\n"
+        "Return STRICT JSON: {\"results\":[{\"index\":0,\"name_quality\":\"ok|weak|empty|cant_generate\","
+        "\"suggested_title\":null|string}, ...]} with exactly one entry per product, in input order.\n"
+        "Rules:\n"
+        "- Keep original language (Swedish stays Swedish).\n"
+        "- empty => generate suggestion; weak => generate suggestion; ok => no suggestion.\n"
+        "- Concise, <= 90 characters, no clickbait.\n",
+    ]
+    for i, (row, excerpt) in enumerate(zip(rows, excerpts)):
+        get = row.get
+        parts.append(f"\n### Product {i}\n")
+        for label, feed_key, mapped_key in _PROMPT_FIELDS:
+            parts += (label, ": ", str(get(feed_key) or get(mapped_key)), "\n")
+        parts += ("Page excerpt: ", excerpt, "\n")
+    return "".join(parts)
+
+async def generate_title_assessments_openai(rows: list[dict],
+                                            client: httpx.AsyncClient | None = None,
+                                            sem: asyncio.Semaphore | None = None) -> list[dict | None]:
+    """
+    Assess up to a batch of rows with ONE chat completion. Returns one result
+    per row, in row order; failures are None. Never raises.
+    """
+    out: list[dict | None] = [None] * len(rows)
+    if not rows:
+        return out
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        _log.info("try_openai: key=no")
+        return out
+
+    keys = [_assess_cache_key(row) for row in rows]
+    misses = []
+    for i, key in enumerate(keys):
+        cached = _assess_cache_get(key)
+        if cached is not None:
+            out[i] = cached
+        else:
+            misses.append(i)
+    if not misses:
+        return out
+
+    try:
+        excerpts = await asyncio.gather(
+            *(_fetch_url_text(rows[i].get("URL") or rows[i].get("url")) for i in misses)
+        )
+        payload = {
+            "model": "gpt-4o-mini",
+            "response_format": {"type": "json_object"},
+            "messages": [
+                {"role": "system", "content": "You are a precise product title editor. Respond ONLY with valid JSON."},
+                {"role": "user", "content": _build_batch_prompt([rows[i] for i in misses], excerpts)},
+            ],
+            "temperature": 0.2,
+            "max_tokens": 120 * len(misses) + 100,
+        }
+        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+
+        if sem is not None:
+            await sem.acquire()
+        try:
+            _log.info("try_openai_batch: n=%d", len(misses))
+            obj = await _chat_json(client if client is not None else _openai_client(),
+                                   payload, headers)
+        finally:
+            if sem is not None:
+                sem.release()
+
+        results = obj.get("results") if isinstance(obj, dict) else None
+        for entry in results if isinstance(results, list) else ():
+            if not isinstance(entry, dict) or "name_quality" not in entry:
+                continue
+            idx = entry.get("index")
+            if isinstance(idx, int) and 0 <= idx < len(misses):
+                assess = {"name_quality": entry.get("name_quality"),
+                          "suggested_title": entry.get("suggested_title")}
+                gi = misses[idx]
+                out[gi] = assess
+                _assess_cache_put(keys[gi], assess)
+        _log.info("openai_batch_ok")
+    except Exception:
+        _log.info("openai_batch_fail")
+    return out
+
+async def assess_many(rows: list[dict], batch_size: int = ASSESS_BATCH_SIZE,
+                      max_concurrent: int = ASSESS_MAX_CONCURRENT) -> list[dict | None]:
+    """
+    Assess all rows in batched chat completions (`batch_size` titles per call,
+    at most `max_concurrent` calls in flight) over one shared connection pool.
+    Returns one result per row, in row order; failures are None.
+    """
+    if not rows:
+        return []
+    sem = asyncio.Semaphore(max_concurrent)
+    client = _openai_client()
+    chunks = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    # the per-chunk coroutine never raises, so the group cannot be aborted
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(generate_title_assessments_openai(chunk, client=client, sem=sem))
+                 for chunk in chunks]
+    out: list[dict | None] = []
+    for t in tasks:
+        out.extend(t.result())
+    return out
@@ -2,7 +2,8 @@
 import logging
 from typing import Generator
 
-from sqlalchemy import create_engine
+import orjson
+from sqlalchemy import create_engine, insert
 from sqlmodel import SQLModel, Session
 
 log = logging.getLogger("app.db")
@@ -17,25 +18,87 @@ if DATABASE_URL.startswith("postgresql://"):
 # SSL for Railway proxy hosts (safe to leave on)
 connect_args = {"sslmode": "require"} if ".proxy.rlwy.net" in DATABASE_URL else {}
 
+engine_kwargs = {"pool_pre_ping": True}
+if DATABASE_URL.startswith("postgresql"):
+    # The default 5-connection pool serializes concurrent request handlers
+    # and the ingest write-back. TCP keepalives + statement timeout keep
+    # dead/stuck connections from hogging pool slots behind the proxy.
+    engine_kwargs.update(pool_size=20, max_overflow=40, pool_recycle=1800)
+    connect_args.update(
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=5,
+        options="-c statement_timeout=30000",
+    )
+
 engine = create_engine(
     DATABASE_URL,
-    pool_pre_ping=True,
-    connect_args=connect_args
+    connect_args=connect_args,
+    # JSON columns encode/decode through orjson instead of stdlib json
+    json_serializer=lambda o: orjson.dumps(o).decode(),
+    json_deserializer=orjson.loads,
+    **engine_kwargs,
 )
 
-def init_db() -> None:
-    # Ensure models are imported so tables are registered
-    from . import models  # noqa
-    SQLModel.metadata.create_all(bind=engine)
+# Columns added after the first deploys; ensured idempotently on startup.
+EXTRA_COLUMNS = (("name_status", "TEXT"), ("name_suggested", "TEXT"))
 
-    # Add only the title-related columns (idempotent)
+def _ensure_columns() -> None:
+    # One round-trip on Postgres; SQLite (no IF NOT EXISTS before 3.35)
+    # checks the pragma first.
     try:
         with engine.begin() as conn:
-            conn.exec_driver_sql("ALTER TABLE product ADD COLUMN IF NOT EXISTS name_status TEXT")
-            conn.exec_driver_sql("ALTER TABLE product ADD COLUMN IF NOT EXISTS name_suggested TEXT")
+            if engine.dialect.name == "sqlite":
+                have = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(product)")}
+                for col, typ in EXTRA_COLUMNS:
+                    if col not in have:
+                        conn.exec_driver_sql(f"ALTER TABLE product ADD COLUMN {col} {typ}")
+            else:
+                conn.exec_driver_sql(
+                    "ALTER TABLE product "
+                    + ", ".join(f"ADD COLUMN IF NOT EXISTS {col} {typ}" for col, typ in EXTRA_COLUMNS)
+                )
     except Exception as e:
         log.warning("Skipping column ensure (name_*): %s", e)
 
+# Indexes backing the issues filters; ensured for DBs created before they
+# were added to the model (create_all only covers brand-new tables).
+EXTRA_INDEXES = (
+    ("ix_product_validation_result", "product", "(validation_result)"),
+    ("ix_product_issue_flags", "product", "(missing_price, missing_identifier, broken_image)"),
+)
+
+def _ensure_indexes() -> None:
+    try:
+        with engine.begin() as conn:
+            for name, table, cols in EXTRA_INDEXES:
+                conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {cols}")
+    except Exception as e:
+        log.warning("Skipping index ensure: %s", e)
+
+def init_db() -> None:
+    # Ensure models are imported so tables are registered
+    from . import models  # noqa
+    SQLModel.metadata.create_all(bind=engine)
+    _ensure_columns()
+    _ensure_indexes()
+
+    # WAL keeps readers unblocked during the bulk ingest write-back
+    if engine.dialect.name == "sqlite":
+        try:
+            with engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+                conn.exec_driver_sql("PRAGMA synchronous=NORMAL")
+        except Exception as e:
+            log.warning("Skipping SQLite pragmas: %s", e)
+
+def bulk_insert_products(session: Session, rows: list[dict], chunk: int = 1000) -> None:
+    # executemany in chunks instead of one ORM INSERT round-trip per row
+    from .models import Product
+    for i in range(0, len(rows), chunk):
+        session.execute(insert(Product), rows[i:i + chunk])
+
 def get_session() -> Generator[Session, None, None]:
     with Session(engine) as session:
         yield session
@@ -1,35 +1,190 @@
-﻿import os, re, httpx, csv, io
+﻿import os, re, ssl, httpx, csv, io
 from typing import Iterable
 from html import unescape
 
+import certifi
+
+# One TLS context for every client in the app; building it (CA bundle parse)
+# costs milliseconds, so it must not happen per client or per handshake.
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+# Optional C-backed HTML parser, as in ai_title; regex strip is the fallback.
+try:
+    from selectolax.parser import HTMLParser as _HTMLParser
+except ImportError:  # pragma: no cover
+    _HTMLParser = None
+
+# Optional native-code CSV parsers for large feeds, tried in order:
+# pyarrow.csv, then pandas, then the pure-Python DictReader fallback.
+try:
+    import pyarrow as _pa
+    import pyarrow.csv as _pacsv
+    _PD_ENGINE = "pyarrow"
+except ImportError:  # pragma: no cover
+    _pa = None
+    _PD_ENGINE = "c"
+try:
+    import pandas as _pd
+except ImportError:  # pragma: no cover
+    _pd = None
+
 CSV_INDEX_URL = "https://hefitness.se/csv/"
 
+# compiled once; fetch_csv_bytes may strip a large index page per ingest
+_PRE_OPEN_RE = re.compile(r"<pre[^>]*>", re.I)
+_PRE_CLOSE_RE = re.compile(r"</pre>", re.I)
+_TAG_RE = re.compile(r"<[^>]+>")
+
 def _strip_html(text: str) -> str:
     text = unescape(text)
-    text = re.sub(r"<pre[^>]*>", "", text, flags=re.I)
-    text = re.sub(r"</pre>", "", text, flags=re.I)
-    text = re.sub(r"<[^>]+>", "", text)
+    text = _PRE_OPEN_RE.sub("", text)
+    text = _PRE_CLOSE_RE.sub("", text)
+    text = _TAG_RE.sub("", text)
     return text
 
+# One client reused across ingest runs instead of a fresh pool per call.
+_CLIENT: httpx.AsyncClient | None = None
+
+def shared_client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = httpx.AsyncClient(
+            timeout=30,
+            follow_redirects=True,
+            verify=SSL_CONTEXT,
+            headers={"User-Agent": "Mozilla/5.0"},
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _CLIENT
+
+async def aclose_client() -> None:
+    """Close the shared client (wired to FastAPI shutdown)."""
+    if _CLIENT is not None and not _CLIENT.is_closed:
+        await _CLIENT.aclose()
+
+# Tried via HEAD before fetching and scraping a directory index page.
+WELL_KNOWN_CSV_NAMES = ("products.csv", "export.csv", "feed.csv")
+
 async def fetch_csv_bytes() -> bytes:
     url = os.getenv("CSV_URL", CSV_INDEX_URL)
-    async with httpx.AsyncClient(timeout=30, follow_redirects=True, verify=False,
-                                 headers={"User-Agent": "Mozilla/5.0"}) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        raw = r.text
-
-    # if <body> exists use it, else use whole text
-    m = re.search(r"<body[^>]*>(.*?)</body>", raw, flags=re.I|re.S)
-    text = m.group(1) if m else raw
+    client = shared_client()
+
+    # common case first: a well-known filename under an index URL means we
+    # never download or strip the HTML listing at all
+    if url.endswith("/"):
+        for name in WELL_KNOWN_CSV_NAMES:
+            try:
+                h = await client.head(url + name)
+                if h.status_code < 400:
+                    r = await client.get(url + name)
+                    r.raise_for_status()
+                    return r.content
+            except Exception:
+                continue
+
+    r = await client.get(url)
+    r.raise_for_status()
+
+    # plain CSV endpoints return the raw body untouched — no str round-trip;
+    # the parser handles \r and noise lines itself
+    content = r.content
+    if not content[:256].lstrip().startswith(b"<"):
+        return content
+
+    raw = content.decode("utf-8", errors="replace")
+
+    # single C-level parse: the CSV listing sits in a <pre> on the index page
+    if _HTMLParser is not None:
+        try:
+            tree = _HTMLParser(raw)
+            node = tree.css_first("pre") or tree.body
+            if node is not None:
+                return node.text().replace("\r", "").strip().encode("utf-8")
+        except Exception:
+            pass
+
+    # if <body> exists use it, else use whole text; C-level find instead of
+    # a lazy-dotall regex over the whole document
+    low = raw.lower()
+    i = low.find("<body")
+    if i != -1:
+        i = raw.find(">", i) + 1
+        j = low.find("</body>", i)
+        text = raw[i:j] if j != -1 else raw[i:]
+    else:
+        text = raw
     text = _strip_html(text).replace("\r","").strip()
     return text.encode("utf-8")
 
-def parse_semicolon_csv(content: bytes) -> Iterable[dict]:
-    text = content.decode("utf-8", errors="replace")
-    # keep only lines that contain semicolons
-    lines = [ln for ln in text.split("\n") if ";" in ln]
-    text = "\n".join(lines)
-    reader = csv.DictReader(io.StringIO(text), delimiter=";")
+# Columns whose values repeat across most rows; interned to one str object
+# per unique value instead of a fresh copy per row.
+LOW_CARDINALITY_COLUMNS = {"Varugrupp", "Tillverkare", "Frakt"}
+
+def _rows_pyarrow(data: bytes) -> Iterable[dict]:
+    # read the header first so every column parses as a string; downstream
+    # numeric coercion stays in one place (main._to_float/_to_int)
+    header = data.split(b"\n", 1)[0].decode("utf-8", "replace")
+    names = [h.strip() for h in header.split(";")]
+    table = _pacsv.read_csv(
+        _pa.BufferReader(data),
+        parse_options=_pacsv.ParseOptions(delimiter=";"),
+        convert_options=_pacsv.ConvertOptions(column_types={n: _pa.string() for n in names}),
+    )
+    pool: dict[str, str] = {}
+    for row in table.to_pylist():
+        out = {}
+        for k, v in row.items():
+            v = v.strip() if isinstance(v, str) else ""
+            if k in LOW_CARDINALITY_COLUMNS:
+                v = pool.setdefault(v, v)
+            out[k] = v
+        yield out
+
+def _rows_pandas(data: bytes) -> Iterable[dict]:
+    df = _pd.read_csv(io.BytesIO(data), sep=";", engine=_PD_ENGINE,
+                      dtype=str, keep_default_na=False)
+    cols = [c.strip() for c in df.columns]
+    pool: dict[str, str] = {}
+    for tup in df.itertuples(index=False, name=None):
+        out = {}
+        for k, v in zip(cols, tup):
+            v = v.strip() if isinstance(v, str) else ""
+            if k in LOW_CARDINALITY_COLUMNS:
+                v = pool.setdefault(v, v)
+            out[k] = v
+        yield out
+
+def _rows_dictreader(data: bytes) -> Iterable[dict]:
+    text = data.decode("utf-8", errors="replace")
+    # lazy line filter; no joined copy of the payload is ever built
+    reader = csv.DictReader((ln for ln in text.splitlines() if ";" in ln), delimiter=";")
+    pool: dict[str, str] = {}
     for row in reader:
-        yield {k: (v or "").strip() for k, v in row.items()}
+        out = {}
+        for k, v in row.items():
+            v = (v or "").strip()
+            if k in LOW_CARDINALITY_COLUMNS:
+                v = pool.setdefault(v, v)
+            out[k] = v
+        yield out
+
+def parse_semicolon_csv(content: bytes) -> Iterable[dict]:
+    # a UTF-8 BOM would otherwise end up inside the first header name
+    if content.startswith(b"\xef\xbb\xbf"):
+        content = content[3:]
+    # lines without semicolons are leftover HTML noise and are dropped
+    if _pa is not None or _pd is not None:
+        data = b"\n".join(ln for ln in content.splitlines() if b";" in ln)
+        if _pa is not None:
+            try:
+                yield from _rows_pyarrow(data)
+                return
+            except Exception:
+                pass
+        if _pd is not None:
+            try:
+                yield from _rows_pandas(data)
+                return
+            except Exception:
+                pass
+    yield from _rows_dictreader(content)
@@ -1,8 +1,14 @@
 ﻿from datetime import datetime
 from typing import Optional
-from sqlmodel import SQLModel, Field, Column, JSON
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field
 
 class Product(SQLModel, table=True):
+    # /ui/issues and the flagged counts filter on these
+    __table_args__ = (
+        Index("ix_product_issue_flags", "missing_price", "missing_identifier", "broken_image"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     artnr: Optional[str] = Field(index=True)
     category: Optional[str] = None
@@ -27,7 +33,7 @@ class Product(SQLModel, table=True):
     ean_status: Optional[str] = None
     price_status: Optional[str] = None
     image_status: Optional[str] = None
-    validation_result: Optional[str] = None
+    validation_result: Optional[str] = Field(default=None, index=True)
 
     # NEW
     name_status: Optional[str] = None
@@ -35,6 +41,11 @@ class Product(SQLModel, table=True):
 
     improved_title: Optional[str] = None
     ai_prompt: Optional[str] = None
-    raw: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class LlmCache(SQLModel, table=True):
+    # Cached OpenAI title assessments keyed by a hash of the prompt fields.
+    key: str = Field(primary_key=True)
+    response: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
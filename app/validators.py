@@ -1,24 +1,122 @@
-﻿import re
+﻿import os
+import re
+import time
+import asyncio
 import httpx
+from itertools import islice
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from .ingest import shared_client
 
 IDENTIFIER_MISSING_PAT = re.compile(r"identifier_exists\s*=\s*no", re.I)
 
-async def check_image_ok(url: str) -> bool:
+# Polite cap per image host; the pool's global limits still apply on top.
+# Per-host (not global) so one slow CDN cannot stall probes to the others.
+IMAGE_HOST_CONCURRENCY = int(os.getenv("IMAGE_HOST_CONCURRENCY", "8"))
+_HOST_SEMS: defaultdict[str, asyncio.Semaphore] = defaultdict(
+    lambda: asyncio.Semaphore(IMAGE_HOST_CONCURRENCY)
+)
+
+async def check_image_ok(url: str, client: httpx.AsyncClient | None = None) -> bool:
     if not url or not url.startswith("http"):
         return False
     try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            r = await client.head(url)
-            if r.status_code >= 400 or r.status_code == 405:
-                r = await client.get(url, headers={"Range": "bytes=0-128"})
-            return r.status_code < 400
+        # default to the shared pool instead of a throwaway client per call
+        async with _HOST_SEMS[urlsplit(url).netloc]:
+            return await _probe_image(client or shared_client(), url)
     except Exception:
         return False
 
+# Feeds repeat CDN URLs across variants and re-ingests re-check them;
+# remember results per URL so each is probed once per TTL window. The
+# in-flight map coalesces the concurrent ingest wave: the first task to see
+# a URL probes it, the rest await its future instead of issuing duplicate
+# HEADs. Entries expire so a fixed URL goes broken/fixed within an hour,
+# and the cache is size-capped so it cannot grow without bound.
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", "3600"))
+IMAGE_CACHE_MAX = 50_000
+_IMAGE_OK: dict[str, tuple[bool, float]] = {}
+_IMAGE_INFLIGHT: dict[str, asyncio.Future] = {}
+
+def _cache_get(url: str) -> bool | None:
+    hit = _IMAGE_OK.get(url)
+    if hit is None:
+        return None
+    ok, expires = hit
+    if expires < time.monotonic():
+        del _IMAGE_OK[url]
+        return None
+    return ok
+
+def _cache_put(url: str, ok: bool) -> None:
+    if len(_IMAGE_OK) >= IMAGE_CACHE_MAX:
+        # dicts iterate in insertion order, so this sheds the oldest tenth
+        for k in list(islice(_IMAGE_OK, IMAGE_CACHE_MAX // 10)):
+            del _IMAGE_OK[k]
+    _IMAGE_OK[url] = (ok, time.monotonic() + IMAGE_CACHE_TTL)
+
+async def check_image_ok_cached(url: str, client: httpx.AsyncClient | None = None) -> bool:
+    if not url:
+        return False
+    hit = _cache_get(url)
+    if hit is not None:
+        return hit
+    fut = _IMAGE_INFLIGHT.get(url)
+    if fut is not None:
+        return await fut
+    fut = asyncio.get_running_loop().create_future()
+    _IMAGE_INFLIGHT[url] = fut
+    ok = False
+    try:
+        ok = await check_image_ok(url, client=client)
+        _cache_put(url, ok)
+        return ok
+    finally:
+        # resolve even on cancellation so waiters never hang
+        _IMAGE_INFLIGHT.pop(url, None)
+        if not fut.done():
+            fut.set_result(ok)
+
+async def check_images_ok(urls: list[str | None], client: httpx.AsyncClient | None = None,
+                          progress=None) -> list[bool]:
+    """Probe a batch of image URLs and return one bool per input, in order.
+
+    Each unique URL is probed once through the pooled client (the per-URL
+    cache and in-flight map still apply); `progress`, if given, is called
+    after each unique probe resolves.
+    """
+    unique: dict[str, bool] = {u: False for u in urls if u}
+
+    async def _one(u: str) -> None:
+        unique[u] = await check_image_ok_cached(u, client=client)
+        if progress is not None:
+            progress()
+
+    await asyncio.gather(*(_one(u) for u in unique))
+    return [bool(u) and unique[u] for u in urls]
+
+async def _probe_image(client: httpx.AsyncClient, url: str) -> bool:
+    # HEAD transfers no body at all; only servers that reject it cost a GET,
+    # and that GET is aborted before any body bytes are read.
+    r = await client.head(url, timeout=5)
+    if r.status_code >= 400 or r.status_code == 405:
+        async with client.stream("GET", url, timeout=5) as s:
+            return s.status_code < 400 and _looks_like_image(s)
+    return _looks_like_image(r)
+
+def _looks_like_image(r: httpx.Response) -> bool:
+    # a 200 with an HTML error page is a broken image too; servers that omit
+    # the header get the benefit of the doubt
+    ctype = r.headers.get("content-type", "")
+    return not ctype or ctype.split(";", 1)[0].strip().startswith("image/")
+
+_NON_DIGITS_RE = re.compile(r"\D+")
+
 def is_identifier_missing(ean_field: str | None) -> bool:
     if not ean_field or ean_field.strip() in {"-", "0", "None", ""}:
         return True
     if IDENTIFIER_MISSING_PAT.search(ean_field):
         return True
-    digits = "".join([c for c in ean_field if c.isdigit()])
-    return len(digits) not in (8, 12, 13, 14)
+    # one C-level pass instead of a per-char Python loop + list + join
+    return len(_NON_DIGITS_RE.sub("", ean_field)) not in (8, 12, 13, 14)